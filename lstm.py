@@ -16,25 +16,47 @@ import numpy as np
 import random
 import string
 import os
+import itertools
+import glob
+import shutil
+import collections
+import contextlib
+import queue
+import threading
 from functools import partial
 from time import time
 import tensorflow as tf
 from tensorflow.python.client import device_lib
+from tensorflow.core.protobuf import rewriter_config_pb2
 from IPython.display import display, HTML
 import logging
 
+# The network is a graph run through tf.Session, make sure newer tensorflow releases do not start in eager mode,
+# where every op would be dispatched one by one from python.
+if hasattr(tf, 'compat') and hasattr(tf.compat, 'v1') and hasattr(tf.compat.v1, 'disable_eager_execution'):
+    tf.compat.v1.disable_eager_execution()
 
 logger = logging.getLogger('gpu_compute')
-logger.setLevel(logging.DEBUG)
-fh = logging.FileHandler('gpu_compute.log')
-fh.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s::%(name)s::%(levelname)s %(message)s')
-fh.setFormatter(formatter)
-ch.setFormatter(formatter)
-logger.addHandler(fh)
-logger.addHandler(ch)
+_ID_POOL = string.ascii_uppercase + string.digits
+_graph_counter = itertools.count()  # unique DOM ids for show_graph, leaves the seeded numpy RNG untouched
+
+
+def configure_logger():
+    """Attach the log file and console handlers to the gpu_compute logger.
+    This is done on first use rather than at import time, so importing the module does not create gpu_compute.log.
+    """
+    if logger.handlers:
+        return
+    logger.setLevel(logging.DEBUG)
+    fh = logging.FileHandler('gpu_compute.log')
+    fh.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s::%(name)s::%(levelname)s %(message)s')
+    fh.setFormatter(formatter)
+    ch.setFormatter(formatter)
+    logger.addHandler(fh)
+    logger.addHandler(ch)
 
 
 def reset_graph(seed=42):
@@ -75,7 +97,7 @@ def show_graph(graph_def=None, max_const_size=32):
         <div style="height:600px">
           <tf-graph-basic id="{id}"></tf-graph-basic>
         </div>
-    """.format(data=repr(str(strip_def)), id='graph' + str(np.random.rand()))
+    """.format(data=repr(str(strip_def)), id='graph{}'.format(next(_graph_counter)))
     iframe = """
         <iframe seamless style="width:1600px;height:800px;border:0" srcdoc="{}"></iframe>
     """.format(code.replace('"', '&quot;'))
@@ -83,13 +105,59 @@ def show_graph(graph_def=None, max_const_size=32):
     display(HTML(iframe))
 
 
-def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
-    return ''.join(random.choice(chars) for _ in range(size))
+def id_generator(size=6, chars=_ID_POOL):
+    return ''.join(random.choices(chars, k=size))
+
+
+def aligned_float32(array, alignment=64):
+    """Return array as a C-contiguous float32 array whose data starts on an alignment-byte boundary.
+    Tensorflow can wrap such a buffer as a tensor without copying it, and the host to device copy reads it at
+    full speed.  The array is returned as is when it already qualifies.
+    """
+    array = np.asarray(array)
+    if array.dtype == np.float32 and array.flags['C_CONTIGUOUS'] and array.ctypes.data % alignment == 0:
+        return array
+    nbytes = array.size * np.dtype(np.float32).itemsize
+    buffer = np.empty(nbytes + alignment, dtype=np.uint8)
+    offset = -buffer.ctypes.data % alignment
+    aligned = buffer[offset:offset + nbytes].view(np.float32).reshape(array.shape)
+    aligned[...] = array
+    return aligned
+
+
+class VariationalDropoutWrapper(tf.nn.rnn_cell.RNNCell):
+    """Apply a fixed dropout mask to the outputs of the wrapped cell.
+    Unlike tf.nn.rnn_cell.DropoutWrapper, the mask is sampled once outside of the time loop and the same mask is
+    used at every time step.  The mask needs to have shape [batch_size, output_size].
+    """
+
+    def __init__(self, cell, mask):
+        super(VariationalDropoutWrapper, self).__init__()
+        self._cell = cell
+        self._mask = mask
+
+    @property
+    def state_size(self):
+        return self._cell.state_size
+
+    @property
+    def output_size(self):
+        return self._cell.output_size
+
+    def zero_state(self, batch_size, dtype):
+        with tf.name_scope(type(self).__name__ + 'ZeroState', values=[batch_size]):
+            return self._cell.zero_state(batch_size, dtype)
+
+    def __call__(self, inputs, state, scope=None):
+        # Like DropoutWrapper, call the wrapped cell directly so its variables keep their names
+        output, new_state = self._cell(inputs, state, scope=scope)
+        return output * self._mask, new_state
 
 
 class LSTM:
     """Container for multi-time-step and multi-layered LSTM framework"""
     global logger
+    _device_cache = None  # compute devices on the local node, shared by all instances
 
     def __init__(self, n_input_features=None, n_output_features=1, batch_size=None,
                  cell_type='LSTM', n_states=50, n_layers=1, use_peepholes=True, n_time_steps=10,
@@ -97,7 +165,10 @@ class LSTM:
                  start_learning_rate=0.001, decay_steps=1, decay_rate=0.3,
                  inner_iteration=10, forward_step=1, create_graph=True,
                  scope='lstm', log_dir='logs', model_dir='saved_models',
-                 device='gpu', device_num=0, verbose=0):
+                 device='gpu', device_num=0, use_xla=True, use_caching_allocator=True,
+                 refresh_devices=False, fixed_cutoff=None, swap_memory=False, dtype=tf.float32,
+                 enable_summaries=False, verbose=0):
+        configure_logger()
         self.n_input_features = n_input_features
         self.n_output_features = n_output_features
         self.batch_size = batch_size
@@ -120,12 +191,37 @@ class LSTM:
         self.graph = None
         self.graph_keys = None
         self.graph_ready = False
+        self.use_cudnn = False
         self.graph_trained = False
         self.trained_epochs = 0
         self.scope = scope
         self.log_dir = log_dir
         self.model_saver = None
         self.model_dir = model_dir
+        self.use_xla = use_xla  # XLA JIT auto-clustering of the training session
+        # When False, GPU memory is allocated with plain cudaMalloc instead of tensorflow's BFC pool.  Allocations
+        # are slightly slower, but the long-lived parameters no longer fragment the pool, which lowers peak memory
+        # (often by 1+ GB for big graphs) and leaves room for larger batch_size / n_time_steps.
+        # The allocator is a per process setting: only the first instance that initializes the GPUs decides it,
+        # and every later instance of the process uses the same allocator, whatever it asks for.
+        self.use_caching_allocator = use_caching_allocator
+        # Swapping the RNN activations to host memory costs a device-host round trip per time step, only
+        # turn it on for very long sequences that do not fit in GPU memory.
+        self.swap_memory = swap_memory
+        # XLA only specializes and fuses on static shapes, so the graph is best built for a fixed batch_size and,
+        # when every batch is split at the same row, a fixed in-sample cutoff which is then a graph constant.
+        self.fixed_cutoff = fixed_cutoff
+        # tf.float16 trains with automatic mixed precision on GPU: the RNN and fc1 matmuls run in float16 on the
+        # tensor cores, the variables, loss and optimizer stay in float32 and the loss is scaled dynamically.
+        self.dtype = tf.as_dtype(dtype)
+        if self.dtype not in (tf.float32, tf.float16):
+            raise ValueError("dtype must be tf.float32 or tf.float16, got %s" % self.dtype.name)
+        self._mixed_precision = False  # set by create_lstm_graph when the float16 rewrite can be used
+        # TensorBoard summaries and the graph dump in log_dir are only written when asked for, or with verbose >= 1
+        self.enable_summaries = enable_summaries
+        if self.use_xla and self.batch_size is None:
+            logger.warning("use_xla works best with a fixed batch_size, batch_size=None leaves XLA with "
+                           "dynamic shapes and little room for fusion.")
 
         # results holder
         self.all_actual_is = None
@@ -141,8 +237,25 @@ class LSTM:
         self.cell_states = dict()  # dictionary holding the last layer rnn cell states
         self.fc_states = dict()  # dictionary holding the rnn to output fc layer states
 
+        # input pipeline: the data_feeder being trained on, and the per batch values that stay on the python side
+        self._train_feeder = None
+        self._batch_info = collections.deque()
+        self._weight_tensors = dict()  # last rnn layer weights returned by train(return_weights=True)
+
+        # The allocator is picked once when the GPU devices are first initialized in the process, which
+        # happens while locating the compute devices below.
+        if not self.use_caching_allocator:
+            if LSTM._device_cache is not None and os.environ.get('TF_GPU_ALLOCATOR') != 'cuda_malloc':
+                logger.warning("use_caching_allocator=False has no effect, the GPU devices of this process were "
+                               "already initialized with the default allocator.")
+            os.environ.setdefault('TF_GPU_ALLOCATOR', 'cuda_malloc')
+        elif os.environ.get('TF_GPU_ALLOCATOR') == 'cuda_malloc':
+            logger.warning("use_caching_allocator=True has no effect, TF_GPU_ALLOCATOR=cuda_malloc is set for "
+                           "this process.")
+
         # Locate available computing devices and save in self.device_list
-        self.device_list = self.find_compute_devices()
+        # The device list is cached at the class level, use refresh_devices=True to enumerate them again.
+        self.device_list = self.find_compute_devices(refresh_devices=refresh_devices)
         if device.lower() == 'cpu':
             self.compute_device = self.device_list['cpu'][0]
         elif device.lower() == 'gpu':
@@ -158,6 +271,15 @@ class LSTM:
                 print("Will default to CPU for computing")
                 self.compute_device = self.device_list['cpu'][0]  # default to cpu as computing device
 
+        if self.use_xla and not self.device_list['xla'] and \
+                not getattr(tf.test, 'is_built_with_xla', lambda: False)():
+            logger.warning("XLA is not available in this tensorflow build, use_xla is ignored.")
+            self.use_xla = False
+
+        # The session config is shared by all the train and predict sessions of this instance
+        self._sess_config = None
+        self.session_config()
+
         # If create_graph is set to True, then create the graph directly during the initiation.
         # You can always reset_graph and recreate new ones later.
         if create_graph:
@@ -175,7 +297,9 @@ class LSTM:
                  start_learning_rate=0.001, decay_steps=1, decay_rate=0.3,
                  iter_per_id=10, forward_step=1, create_graph=True,
                  scope='lstm', log_dir='logs', model_dir='saved_models',
-                 device='gpu', device_num=0, verbose=0):
+                 device='gpu', device_num=0, use_xla=True, use_caching_allocator=True,
+                 refresh_devices=False, fixed_cutoff=None, swap_memory=False, dtype=tf.float32,
+                 enable_summaries=False, verbose=0):
         """A wrapper for calling the __init__ function"""
 
         if self.graph is not None:
@@ -190,46 +314,66 @@ class LSTM:
                       start_learning_rate=start_learning_rate, decay_steps=decay_steps, decay_rate=decay_rate,
                       inner_iteration=iter_per_id, forward_step=forward_step, create_graph=create_graph,
                       scope=scope, log_dir=log_dir, model_dir=model_dir,
-                      device=device, device_num=device_num, verbose=verbose
+                      device=device, device_num=device_num, use_xla=use_xla,
+                      use_caching_allocator=use_caching_allocator, refresh_devices=refresh_devices,
+                      fixed_cutoff=fixed_cutoff, swap_memory=swap_memory, dtype=dtype,
+                      enable_summaries=enable_summaries, verbose=verbose
                       )
 
 
     def logging_session_parameters(self, log=None):
         if log is None:
             log = logger
-        log.info(f"[{self.sessid}] Session start")
-        log.info(f"[{self.sessid}] Input features: {self.n_input_features}")
-        log.info(f"[{self.sessid}] Output features: {self.n_output_features}")
-        log.info(f"[{self.sessid}] Num of units in each {self.cell_type} cell: {self.n_states}")
-        log.info(f"[{self.sessid}] Num of stacked {self.cell_type} layers: {self.n_layers}")
-        log.info(f"[{self.sessid}] Num of unrolled time steps: {self.n_time_steps}")
-        log.info(f"[{self.sessid}] Activation function: {self.activation.__name__}")
-        log.info(f"[{self.sessid}] Dropout rate during training: {1 - self.keep_prob}")
-        log.info(f"[{self.sessid}] L1 regularization: {self.l1_reg_scale}")
-        log.info(f"[{self.sessid}] L2 regularization: {self.l2_reg_scale}")
-        log.info(f"[{self.sessid}] Start learning rate: {self.start_learning_rate}")
-        log.info(f"[{self.sessid}] Learning rate decay steps: {self.decay_steps}")
-        log.info(f"[{self.sessid}] Learning rate decay rate: {self.decay_rate}")
-        log.info(f"[{self.sessid}] Inner iterations: {self.inner_iteration}")
-        log.info(f"[{self.sessid}] Forward prediction period: {self.forward_step}")
-
-
-    @staticmethod
-    def find_compute_devices():
+        # One multi-line record instead of a separate formatted write per parameter
+        log.info(
+            f"[{self.sessid}] Session start\n"
+            f"[{self.sessid}] Input features: {self.n_input_features}\n"
+            f"[{self.sessid}] Output features: {self.n_output_features}\n"
+            f"[{self.sessid}] Num of units in each {self.cell_type} cell: {self.n_states}\n"
+            f"[{self.sessid}] Num of stacked {self.cell_type} layers: {self.n_layers}\n"
+            f"[{self.sessid}] Num of unrolled time steps: {self.n_time_steps}\n"
+            f"[{self.sessid}] Activation function: {self.activation.__name__}\n"
+            f"[{self.sessid}] Dropout rate during training: {1 - self.keep_prob}\n"
+            f"[{self.sessid}] L1 regularization: {self.l1_reg_scale}\n"
+            f"[{self.sessid}] L2 regularization: {self.l2_reg_scale}\n"
+            f"[{self.sessid}] Start learning rate: {self.start_learning_rate}\n"
+            f"[{self.sessid}] Learning rate decay steps: {self.decay_steps}\n"
+            f"[{self.sessid}] Learning rate decay rate: {self.decay_rate}\n"
+            f"[{self.sessid}] Inner iterations: {self.inner_iteration}\n"
+            f"[{self.sessid}] Forward prediction period: {self.forward_step}"
+        )
+
+
+    @classmethod
+    def find_compute_devices(cls, refresh_devices=False):
         """Find available compute devices (gpu's and cpu's) on the local node and store them as a dictionary.
         Note:
             Tensorflow lumps all available cpu cores together as a single cpu resource.  GPU devices will be
             separate.
+            Listing the devices spins up a throwaway session, so the result is cached for all instances.
+            Pass refresh_devices=True to enumerate the devices again.
         """
-        device_list = device_lib.list_local_devices()
-        gpu, cpu = [], []
-        for device in device_list:
-            if device.name.find('GPU') != -1:
-                gpu.append(device.name)
-            if device.name.find('CPU') != -1:
-                cpu.append(device.name)
-        assert len(cpu) >= 1  # assert at least cpu resource is available
-        return dict(gpu=gpu, cpu=cpu)
+        if cls._device_cache is None or refresh_devices:
+            # Listing the devices creates the GPU allocators of the process, the allow_growth of the session
+            # configs only takes effect if it is already set here.
+            config = tf.ConfigProto()
+            config.gpu_options.allow_growth = True
+            try:
+                device_list = device_lib.list_local_devices(session_config=config)
+            except TypeError:  # tensorflow < 1.9 has no session_config argument
+                device_list = device_lib.list_local_devices()
+            gpu, cpu, xla = [], [], []
+            for device in device_list:
+                if device.device_type.startswith('XLA'):
+                    # XLA_CPU/XLA_GPU devices are only registered by tensorflow builds with XLA
+                    xla.append(device.name)
+                elif device.name.find('GPU') != -1:
+                    gpu.append(device.name)
+                elif device.name.find('CPU') != -1:
+                    cpu.append(device.name)
+            assert len(cpu) >= 1  # assert at least cpu resource is available
+            cls._device_cache = dict(gpu=gpu, cpu=cpu, xla=xla)
+        return cls._device_cache
 
 
     def show_compute_devices(self):
@@ -250,6 +394,8 @@ class LSTM:
             print("Error in selecting target device, defaulting to CPU as compute device. \n"
                   "Please use show_compute_devices() to list available compute devices.")
             self.compute_device = self.device_list['cpu'][0]  # default to cpu as computing device
+        # the cached session config was built for the previous device
+        self._sess_config = None
 
 
     def reset_graph(self):
@@ -264,17 +410,22 @@ class LSTM:
 
 
     @staticmethod
-    def get_tf_normal_variable(shape, mean=0.0, stddev=0.6, name=None):
-        """Obtain a tf.Variable with desired shape and to be initialized with truncated normal
-        distribution.
+    def get_tf_variable(shape, name, mean=None, stddev=None, initializer=None):
+        """Obtain a tf.Variable with desired static shape, initialized with the Glorot uniform initializer.
+        If stddev is given, a truncated normal distribution with that stddev (and mean) is used instead.
         """
-        return tf.Variable(tf.truncated_normal(shape, mean=mean, stddev=stddev),
-                           validate_shape=False, name=name)
+        if initializer is None:
+            if stddev is None:
+                initializer = tf.glorot_uniform_initializer()
+            else:
+                initializer = tf.truncated_normal_initializer(mean=0.0 if mean is None else mean, stddev=stddev)
+        return tf.get_variable(name, shape=shape, initializer=initializer)
 
-    def create_lstm_graph(self, n_input_features=None, reset_graph=True, log=None, verbose=0):
+    def create_lstm_graph(self, n_input_features=None, reset_graph=True, fixed_cutoff=None, log=None, verbose=0):
         """Build the Tensorflow based LSTM network
         Input::
         n_input_features: number of input features, there is no default value and has to be provided.
+        fixed_cutoff: if every batch has the same in_sample_size, bake it into the graph as a constant.
         Return::  tensor references that need to be referenced later
         """
         if log is None:
@@ -285,6 +436,21 @@ class LSTM:
         else:
             self.n_input_features = n_input_features
 
+        if fixed_cutoff is not None:
+            self.fixed_cutoff = fixed_cutoff
+
+        static_shapes = self.batch_size is not None and self.n_time_steps is not None and \
+            self.fixed_cutoff is not None
+        if self.use_xla and static_shapes:
+            # Mark the network, stats and loss ops (and their gradients) for XLA explicitly, so they are
+            # compiled even where the global jit level of the session does not cluster them, e.g. on CPU.
+            # Ops without an XLA kernel, like the cuDNN and fused LSTM kernels, are left out of the clusters.
+            # Only done when every batch has the same shapes, otherwise each new batch size or in-sample cutoff
+            # would compile the clusters again.  Without static shapes XLA is left to the session jit level.
+            jit_scope = partial(tf.contrib.compiler.jit.experimental_jit_scope, compile_ops=True)
+        else:
+            jit_scope = contextlib.ExitStack  # no-op context
+
         if self.graph is None:
             self.graph = tf.Graph()
         elif reset_graph:
@@ -299,103 +465,247 @@ class LSTM:
                 with tf.name_scope(self.scope):
                     # Define input placeholder X
                     with tf.name_scope('input'):
+                        # The training batches stream in through a tf.data pipeline that runs the data_feeder
+                        # of train on a background thread and keeps a few batches ready ahead of the compute.
+                        # X, y and in_sample_cutoff default to the pipeline but can still be fed directly.
+                        with tf.device('/cpu:0'):
+                            # every batch is repeated for the training calls run on it (see train)
+                            n_repeats = tf.placeholder(tf.int64, shape=(), name='n_repeats')
+                            dataset = tf.data.Dataset.from_generator(
+                                self._batch_generator,
+                                output_types=(tf.float32, tf.float32, tf.int32, tf.float32, tf.float32),
+                                output_shapes=(
+                                    tf.TensorShape([self.batch_size, self.n_time_steps, self.n_input_features]),
+                                    tf.TensorShape([self.batch_size, self.n_output_features]),
+                                    tf.TensorShape([]),
+                                    tf.TensorShape(None),  # y_is_mean and y_is_std only have to broadcast with y
+                                    tf.TensorShape(None)
+                                )
+                            )
+                            dataset = dataset.flat_map(
+                                lambda *batch: tf.data.Dataset.from_tensors(batch).repeat(n_repeats)
+                            )
+                            dataset = dataset.prefetch(4)
+                            data_iterator = dataset.make_initializable_iterator()
+                            next_X, next_y, next_cutoff, next_y_mean, next_y_std = data_iterator.get_next()
+
+                        if self.compute_device.find('GPU') != -1:
+                            # Keep the next batch staged on the GPU: every training step also puts the following
+                            # batch into the StagingArea, so its host to device copy overlaps the current step.
+                            next_batch = [next_X, next_y, next_cutoff, next_y_mean, next_y_std]
+                            stage = tf.contrib.staging.StagingArea(
+                                dtypes=[tensor.dtype for tensor in next_batch],
+                                shapes=[tensor.shape for tensor in next_batch]
+                            )
+                            stage_put = stage.put(next_batch)
+                            next_X, next_y, next_cutoff, next_y_mean, next_y_std = stage.get()
+                        else:
+                            stage_put = None
+
                         with tf.name_scope('X'):
                             # [None, n_time_steps, n_input_features]
                             # n_input_features should include all the inputs flattened into a vector
-                            X = tf.placeholder(tf.float32, shape=[self.batch_size, self.n_time_steps,
-                                                                  self.n_input_features], name='X')
+                            X = tf.placeholder_with_default(next_X, shape=[self.batch_size, self.n_time_steps,
+                                                                           self.n_input_features], name='X')
 
                     with tf.name_scope('hyperparameters'):
-                        with tf.name_scope('keep_prob'):
-                            # Define keep_prob placeholder for dropout
-                            keep_prob = tf.placeholder(tf.float32, name='keep_prob')
+                        with tf.name_scope('is_training'):
+                            # Dropout is only applied when is_training is fed True, prediction and evaluation
+                            # runs leave it to its default
+                            is_training = tf.placeholder_with_default(False, shape=(), name='is_training')
 
                         with tf.name_scope('in_sample_cutoff'):
                             # Split point between training and test
                             # Only the training portion will be included in the loss function calculation
-                            in_sample_cutoff = tf.placeholder(tf.int32, shape=(), name='in_sample_cutoff')
+                            # A constant cutoff lets the in-sample/out-of-sample slices be folded at compile time
+                            if self.fixed_cutoff is None:
+                                in_sample_cutoff = tf.placeholder_with_default(next_cutoff, shape=(),
+                                                                               name='in_sample_cutoff')
+                            else:
+                                in_sample_cutoff = tf.constant(self.fixed_cutoff, dtype=tf.int32,
+                                                               name='in_sample_cutoff')
 
                     # Define multilayer LSTM network
                     with tf.name_scope('model'):
                         with tf.name_scope('rnn'):
-                            # Adding dropout wrapper layer and LSTM cells with the number of hidden units
-                            # in each LSTMCell as n_states.
+                            # LSTM/GRU/RNN cells with the number of hidden units in each cell as n_states.
                             # We have disabled the use_peepholes for now, can experiment its effect in the future.
-                            if self.cell_type == 'LSTM':
-                                lstm_layers = [
-                                    tf.nn.rnn_cell.DropoutWrapper(
-                                        tf.nn.rnn_cell.LSTMCell(num_units=self.n_states,
-                                                                use_peepholes=self.use_peepholes,
-                                                                forget_bias=1.0, activation=self.activation,
-                                                                state_is_tuple=True),
-                                        output_keep_prob=self.keep_prob
-                                    )
+
+                            # On GPU the rnn layers are handed to cuDNN, which fuses the gate GEMMs of all
+                            # the layers and the post-GEMM element-wise ops into a few kernels.  cuDNN only has
+                            # tanh LSTM/GRU and tanh/relu vanilla RNN kernels, other activations keep the tf cells.
+                            # The fused LSTM block kernels are tanh only as well.
+                            fused_lstm = self.cell_type == 'LSTM' and self.activation is tf.tanh
+                            cudnn_layer = None
+                            if self.compute_device.find('GPU') != -1:
+                                if fused_lstm:
+                                    cudnn_layer = tf.contrib.cudnn_rnn.CudnnLSTM
+                                elif self.cell_type == 'GRU' and self.activation is tf.tanh:
+                                    cudnn_layer = tf.contrib.cudnn_rnn.CudnnGRU
+                                elif self.cell_type == 'RNN' and self.activation is tf.tanh:
+                                    cudnn_layer = tf.contrib.cudnn_rnn.CudnnRNNTanh
+                                elif self.cell_type == 'RNN' and self.activation is tf.nn.relu:
+                                    cudnn_layer = tf.contrib.cudnn_rnn.CudnnRNNRelu
+                                else:
+                                    log.info(f"cuDNN has no {self.cell_type} kernel with activation "
+                                             f"{self.activation.__name__}, using the tensorflow cells.")
+                            self.use_cudnn = cudnn_layer is not None
+
+                            if self.use_cudnn:
+                                if self.cell_type == 'LSTM' and self.use_peepholes:
+                                    log.warning("cuDNN LSTM does not support peepholes, use_peepholes is ignored.")
+                                # cuDNN applies the dropout between the stacked layers, only when it is called
+                                # with training=True, see build_network.
+                                multilayer_cell = cudnn_layer(num_layers=self.n_layers, num_units=self.n_states,
+                                                              direction='unidirectional', dropout=1 - self.keep_prob)
+                                # Create the opaque parameters here, variables cannot be created inside the
+                                # tf.cond branches that call the layer
+                                with tf.variable_scope('rnn'):
+                                    multilayer_cell.build([self.n_time_steps, self.batch_size, self.n_input_features])
+
+                            elif fused_lstm:
+                                # LSTMBlockFusedCell runs the whole sequence of one layer as a single fused
+                                # kernel instead of a while-loop of small per-step ops.  It is time-major and
+                                # cannot be wrapped in MultiRNNCell, so the layers are stacked by hand below.
+                                rnn_layers = [
+                                    tf.contrib.rnn.LSTMBlockFusedCell(num_units=self.n_states, forget_bias=1.0,
+                                                                      use_peephole=self.use_peepholes,
+                                                                      name='lstm_cell')
+                                    for _ in range(self.n_layers)
+                                ]
+
+                            elif self.cell_type == 'LSTM':
+                                rnn_layers = [
+                                    tf.nn.rnn_cell.LSTMCell(num_units=self.n_states, use_peepholes=self.use_peepholes,
+                                                            forget_bias=1.0, activation=self.activation,
+                                                            state_is_tuple=True)
                                     for _ in range(self.n_layers)
                                 ]
-                                multilayer_cell = tf.nn.rnn_cell.MultiRNNCell(lstm_layers, state_is_tuple=True)
 
                             elif self.cell_type == 'GRU':
-                                gru_layers = [
-                                    tf.nn.rnn_cell.DropoutWrapper(
-                                        tf.nn.rnn_cell.GRUCell(num_units=self.n_states, activation=self.activation),
-                                        output_keep_prob=self.keep_prob
-                                    )
+                                rnn_layers = [
+                                    tf.nn.rnn_cell.GRUCell(num_units=self.n_states, activation=self.activation)
                                     for _ in range(self.n_layers)
                                 ]
-                                multilayer_cell = tf.nn.rnn_cell.MultiRNNCell(gru_layers, state_is_tuple=True)
 
                             elif self.cell_type == 'RNN':
                                 rnn_layers = [
-                                    tf.nn.rnn_cell.DropoutWrapper(
-                                        tf.nn.rnn_cell.BasicRNNCell(num_units=self.n_states,
-                                                                    activation=self.activation),
-                                        output_keep_prob=self.keep_prob
-                                    )
+                                    tf.nn.rnn_cell.BasicRNNCell(num_units=self.n_states, activation=self.activation)
                                     for _ in range(self.n_layers)
                                 ]
-                                multilayer_cell = tf.nn.rnn_cell.MultiRNNCell(rnn_layers, state_is_tuple=True)
                             else:
                                 assert False, f"cell_type {self.cell_type} is not recognized"
 
-                        with tf.name_scope('dynamical_unrolling'):
-                            # init_states = []
-                            # for _ in range(len(lstm_layers)):
-                            #     cell_state = get_tf_normal_variable((batch_size, n_states))
-                            #     hidden_state = get_tf_normal_variable((batch_size, n_states))
-                            #     state_tuple = tf.nn.rnn_cell.LSTMStateTuple(cell_state, hidden_state)
-                            #     init_states.append(state_tuple)
-
-                            # Use dynamic_rnn to dynamically unroll the time steps when doing the computation
-                            # outputs contain the output from all the time steps, so it should have
-                            # shape [batch_size, n_time_steps, n_states]
-                            # When time_major is set to True, the outputs shape should be
-                            # [n_time_steps, batch_size, n_states]
-                            # states contain the all the internal states at the last time step.
-                            # It is a tuple with elements corresponding to n_layers. Each tuple element itself
-                            # is a LSTMStateTuple with c and h tensors.
-                            outputs, states = tf.nn.dynamic_rnn(cell=multilayer_cell, inputs=X,
-                                                                initial_state=None, dtype=tf.float32,
-                                                                swap_memory=True, time_major=False)
-
                         # Use a fully-connected layer to convert the multi-state vector into a single
                         # scalar representing the variable to be predicted
                         with tf.name_scope('fc1'):
-                            with tf.name_scope('W'):
-                                W_fc1 = self.get_tf_normal_variable([self.n_states, self.n_output_features],
-                                                                    name='W_fc1')
-                            with tf.name_scope('b'):
-                                b_fc1 = self.get_tf_normal_variable([self.n_output_features], name='b_fc1')
+                            # Same variable names as the former tf.Variable's under the W and b name scopes,
+                            # so previously saved models still restore
+                            with tf.variable_scope(f'{self.scope}/model/fc1/W'):
+                                W_fc1 = self.get_tf_variable([self.n_states, self.n_output_features], name='W_fc1')
+                            with tf.variable_scope(f'{self.scope}/model/fc1/b'):
+                                b_fc1 = self.get_tf_variable([self.n_output_features], name='b_fc1',
+                                                             initializer=tf.zeros_initializer())
+
+                        def build_network(X):
+                            """Unroll the rnn layers over X and apply fc1, returns outputs, states and pred.
+                            Every call shares the cells, W_fc1 and b_fc1, and samples its own dropout masks.
+                            """
+                            # Variational dropout: each layer gets one [batch_size, n_states] mask sampled
+                            # once per run and broadcast over all the time steps, rather than DropoutWrapper
+                            # sampling a new mask inside the loop at every time step.
+                            mask_shape = [tf.shape(X)[0], self.n_states]
+
+                            def dropout_mask():
+                                # Outside of training the mask is all ones and no random numbers are drawn
+                                return tf.cond(is_training,
+                                               lambda: tf.nn.dropout(tf.ones(mask_shape), self.keep_prob),
+                                               lambda: tf.ones(mask_shape))
+
+                            with tf.name_scope('dynamical_unrolling'):
+                                # init_states = []
+                                # for _ in range(len(lstm_layers)):
+                                #     cell_state = get_tf_normal_variable((batch_size, n_states))
+                                #     hidden_state = get_tf_normal_variable((batch_size, n_states))
+                                #     state_tuple = tf.nn.rnn_cell.LSTMStateTuple(cell_state, hidden_state)
+                                #     init_states.append(state_tuple)
+
+                                # The layers are unrolled time-major, i.e. on [n_time_steps, batch_size, ...],
+                                # which is what the fused kernels expect, and transposed back afterwards.
+                                # outputs contain the output from all the time steps, so it should have
+                                # shape [batch_size, n_time_steps, n_states]
+                                # states contain the all the internal states at the last time step.
+                                # It is a tuple with elements corresponding to n_layers. For LSTM each tuple
+                                # element itself is a LSTMStateTuple with c and h tensors.
+                                if self.use_cudnn:
+                                    # h (and c for LSTM) have shape [n_layers, batch_size, n_states]
+                                    # The training branch runs the inter-layer dropout, prediction and evaluation
+                                    # runs take the deterministic one
+                                    time_major_X = tf.transpose(X, [1, 0, 2])
+                                    with tf.variable_scope('rnn'):
+                                        layer_outputs, cudnn_states = tf.cond(
+                                            is_training,
+                                            lambda: multilayer_cell(time_major_X, training=True),
+                                            lambda: multilayer_cell(time_major_X, training=False)
+                                        )
+                                    layer_outputs = layer_outputs * dropout_mask()
+                                    if self.cell_type == 'LSTM':
+                                        h, c = cudnn_states
+                                        states = tuple(tf.nn.rnn_cell.LSTMStateTuple(c[layer], h[layer])
+                                                       for layer in range(self.n_layers))
+                                    else:
+                                        h = cudnn_states[0]
+                                        states = tuple(h[layer] for layer in range(self.n_layers))
+                                elif fused_lstm:
+                                    # Feed layer N+1 with the outputs of layer N, keeping the variable names
+                                    # MultiRNNCell would have given them (rnn/multi_rnn_cell/cell_N/lstm_cell).
+                                    layer_outputs = tf.transpose(X, [1, 0, 2])
+                                    states = []
+                                    with tf.variable_scope('rnn'):
+                                        with tf.variable_scope('multi_rnn_cell'):
+                                            for layer, lstm_cell in enumerate(rnn_layers):
+                                                with tf.variable_scope(f'cell_{layer}'):
+                                                    layer_outputs, state = lstm_cell(layer_outputs,
+                                                                                     dtype=tf.float32)
+                                                # Like DropoutWrapper(output_keep_prob), the states are untouched
+                                                layer_outputs = layer_outputs * dropout_mask()
+                                                states.append(state)
+                                    states = tuple(states)
+                                else:
+                                    # The cells are wrapped with this call's masks, their variables are shared
+                                    multilayer_cell = tf.nn.rnn_cell.MultiRNNCell(
+                                        [VariationalDropoutWrapper(cell, mask=dropout_mask()) for cell in rnn_layers],
+                                        state_is_tuple=True
+                                    )
+                                    # Use dynamic_rnn to dynamically unroll the time steps when doing the
+                                    # computation.  All the layers run inside the same while-loop,
+                                    # parallel_iterations lets the executor overlap the ops of consecutive time steps.
+                                    # n_time_steps=None leaves the number of time steps open
+                                    parallel_iterations = 32 if self.n_time_steps is None else \
+                                        min(32, self.n_time_steps)
+                                    layer_outputs, states = tf.nn.dynamic_rnn(
+                                        cell=multilayer_cell, inputs=tf.transpose(X, [1, 0, 2]),
+                                        initial_state=None, dtype=tf.float32, swap_memory=self.swap_memory,
+                                        time_major=True, parallel_iterations=parallel_iterations
+                                    )
+                                outputs = tf.transpose(layer_outputs, [1, 0, 2])  # back to batch major
+
                             with tf.name_scope('pred'):
                                 # states[-1][1] is the h states of the last layer LSTM cell
                                 if self.cell_type == 'LSTM':
                                     pred = tf.matmul(states[-1][1], W_fc1) + b_fc1  # [None, n_output_features]
                                 else:
                                     pred = tf.matmul(states[-1], W_fc1) + b_fc1  # [None, n_output_features]
+                            return outputs, states, pred
+
+                        with jit_scope():
+                            outputs, states, pred = build_network(X)
 
                     # Placeholder for the output (label)
                     with tf.name_scope('label'):
                         # y has shape [None, n_output_features]
-                        y = tf.placeholder(tf.float32, shape=[self.batch_size, self.n_output_features], name='y_label')
+                        y = tf.placeholder_with_default(next_y, shape=[self.batch_size, self.n_output_features],
+                                                        name='y_label')
                         # this is important - we only want to train on the in-sample set of rows using TensorFlow
                         y_is = y[0:in_sample_cutoff, :]
                         pred_is = pred[0:in_sample_cutoff, :]
@@ -404,48 +714,76 @@ class LSTM:
                         y_oos = y[in_sample_cutoff:, :]
                         pred_oos = pred[in_sample_cutoff:, :]
 
-                    with tf.name_scope('stats'):
-                        epsilon = 1.e-4
-                        # Pearson correlation to evaluate the model, here is for in-sample training data
-                        covariance_is = tf.matmul(
-                            tf.transpose(tf.subtract(pred_is, tf.reduce_mean(pred_is, axis=0, keepdims=True))),
-                            tf.subtract(y_is, tf.reduce_mean(y_is, axis=0, keepdims=True))
-                        )  # covariance matrix, shape [n_output_features, n_output_features]
-                        var_pred_is = tf.reduce_sum(
-                            tf.square(tf.subtract(pred_is, tf.reduce_mean(pred_is))), axis=0, keepdims=True
-                        )  # variance of pred_is, shape [1, n_output_features]
-                        var_y_is = tf.reduce_sum(
-                            tf.square(tf.subtract(y_is, tf.reduce_mean(y_is))), axis=0, keepdims=True
-                        )  # variance of y_is, shape [1, n_output_features]
-                        # pearson correlation matrix, shape [n_output_features, n_output_features]
-                        pearson_corr_is = tf.div(
-                            covariance_is, tf.sqrt(tf.matmul(tf.transpose(var_pred_is), var_y_is)) + epsilon,
-                            name='pearson_corr_is'
-                        )
+                    with tf.name_scope('reverse_transform'):
+                        # y and pred are normalized, y_mean and y_std of the batch bring them back to the original
+                        # scale in one fused multiply-add, after the stats and the loss were taken on them
+                        # any shape that broadcasts with y, e.g. a scalar, [n_output_features] or [1, n_output_features]
+                        y_mean = tf.placeholder_with_default(next_y_mean, shape=None, name='y_mean')
+                        y_std = tf.placeholder_with_default(next_y_std, shape=None, name='y_std')
+                        with jit_scope():
+                            y_out = tf.add(y * y_std, y_mean, name='y_out')
+                            pred_out = tf.add(pred * y_std, y_mean, name='pred_out')
+                            y_oos_out = y_out[in_sample_cutoff:, :]
+                            pred_oos_out = pred_out[in_sample_cutoff:, :]
+
+                    with jit_scope():
+                        with tf.name_scope('stats'):
+                            epsilon = 1.e-4
+                            # Each tensor is centered once and the centered tensor is shared by the covariance
+                            # and the variance terms.  Only the per output correlations (the diagonal of the
+                            # pred/y correlation matrix) are computed and then averaged into a scalar.
+                            # Pearson correlation to evaluate the model, here is for in-sample training data
+                            mean_pred_is, _ = tf.nn.moments(pred_is, axes=[0], keep_dims=True)
+                            mean_y_is, _ = tf.nn.moments(y_is, axes=[0], keep_dims=True)
+                            centered_pred_is = tf.subtract(pred_is, mean_pred_is, name='centered_pred_is')
+                            centered_y_is = tf.subtract(y_is, mean_y_is, name='centered_y_is')
+                            covariance_is = tf.reduce_sum(
+                                centered_pred_is * centered_y_is, axis=0
+                            )  # covariance of every output, shape [n_output_features]
+                            var_pred_is = tf.reduce_sum(
+                                centered_pred_is * centered_pred_is, axis=0
+                            )  # variance of pred_is, shape [n_output_features]
+                            var_y_is = tf.reduce_sum(
+                                centered_y_is * centered_y_is, axis=0
+                            )  # variance of y_is, shape [n_output_features]
+                            # pearson correlation averaged over all the outputs, a scalar
+                            pearson_corr_is = tf.reduce_mean(
+                                covariance_is / (tf.sqrt(var_pred_is * var_y_is) + epsilon),
+                                name='pearson_corr_is'
+                            )
 
-                        # Pearson correlation for out-of-sample data
-                        covariance_oos = tf.matmul(
-                            tf.transpose(tf.subtract(pred_oos, tf.reduce_mean(pred_oos, axis=0, keepdims=True))),
-                            tf.subtract(y_oos, tf.reduce_mean(y_oos, axis=0, keepdims=True))
-                        )  # covariance matrix, shape [n_output_features, n_output_features]
-                        var_pred_oos = tf.reduce_sum(
-                            tf.square(tf.subtract(pred_oos, tf.reduce_mean(pred_oos))), axis=0, keepdims=True
-                        )  # variance of pred_oos, shape [1, n_output_features]
-                        var_y_oos = tf.reduce_sum(
-                            tf.square(tf.subtract(y_oos, tf.reduce_mean(y_oos))), axis=0, keepdims=True
-                        )  # variance of y_oos, shape [1, n_output_features]
-                        # pearson correlation matrix, shape [n_output_features, n_output_features]
-                        pearson_corr_oos = tf.div(
-                            covariance_oos, tf.sqrt(tf.matmul(tf.transpose(var_pred_oos), var_y_oos)) + epsilon,
-                            name='pearson_corr_oos'
-                        )
+                            # Pearson correlation for out-of-sample data
+                            mean_pred_oos, _ = tf.nn.moments(pred_oos, axes=[0], keep_dims=True)
+                            mean_y_oos, _ = tf.nn.moments(y_oos, axes=[0], keep_dims=True)
+                            centered_pred_oos = tf.subtract(pred_oos, mean_pred_oos, name='centered_pred_oos')
+                            centered_y_oos = tf.subtract(y_oos, mean_y_oos, name='centered_y_oos')
+                            covariance_oos = tf.reduce_sum(
+                                centered_pred_oos * centered_y_oos, axis=0
+                            )  # covariance of every output, shape [n_output_features]
+                            var_pred_oos = tf.reduce_sum(
+                                centered_pred_oos * centered_pred_oos, axis=0
+                            )  # variance of pred_oos, shape [n_output_features]
+                            var_y_oos = tf.reduce_sum(
+                                centered_y_oos * centered_y_oos, axis=0
+                            )  # variance of y_oos, shape [n_output_features]
+                            # pearson correlation averaged over all the outputs, a scalar
+                            pearson_corr_oos = tf.reduce_mean(
+                                covariance_oos / (tf.sqrt(var_pred_oos * var_y_oos) + epsilon),
+                                name='pearson_corr_oos'
+                            )
 
                     with tf.name_scope('hyperparameters'):
                         # set up adaptive learning rate:
                         # Ratio of global_step / decay_steps is designed to indicate how far we've
                         # progressed in training.
                         # the ratio is 0 at the beginning of training and is 1 at the end.
-                        global_step = tf.placeholder(tf.float32, name='global_step')
+                        # global_step lives in the graph and is only assigned once per epoch through
+                        # set_global_step, instead of being fed with every sess.run.  It is a local variable,
+                        # so it is not part of the checkpoints and previously saved models still restore.
+                        global_step = tf.Variable(0.0, trainable=False, dtype=tf.float32, name='global_step',
+                                                  collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                        progress = tf.placeholder(tf.float32, shape=(), name='progress')
+                        set_global_step = tf.assign(global_step, progress, name='set_global_step')
 
                         # tf.train.exponetial_decay is calculated as:
                         #     decayed_learning_rate = learning_rate * decay_rate ^ (global_step / decay_steps)
@@ -468,39 +806,107 @@ class LSTM:
 
                     with tf.name_scope('loss'):
                         # this the loss function for optimization purpose
-                        loss = tf.nn.l2_loss(tf.subtract(y_is, pred_is)) + \
-                               tf.contrib.layers.apply_regularization(
-                                   tf.contrib.layers.l1_l2_regularizer(
-                                       scale_l1=self.l1_reg_scale,
-                                       scale_l2=self.l2_reg_scale
-                                   ),
-                                   tf.trainable_variables()
-                               )
-
-                        # this is the out-of-sample L2 loss, only for observation, never use for optimization
-                        loss_oos = tf.nn.l2_loss(tf.subtract(y_oos, pred_oos))
+                        # The L1 and L2 penalties are summed over all the trainable variables with one add_n
+                        # each, instead of a separate regularizer subgraph per variable.  Same values as
+                        # l1_l2_regularizer: scale_l1 * sum(|w|) + scale_l2 * sum(w ** 2) / 2
+                        def penalized_loss(pred_is):
+                            trainable_variables = tf.trainable_variables()
+                            l1 = tf.add_n([tf.reduce_sum(tf.abs(v)) for v in trainable_variables], name='l1')
+                            l2 = tf.add_n([tf.reduce_sum(tf.square(v)) for v in trainable_variables], name='l2')
+                            # inlined l2_loss, so subtract -> square -> reduce is a single fusable reduction
+                            data_loss = 0.5 * tf.reduce_sum(tf.square(y_is - pred_is))
+                            return tf.add_n([data_loss, 0.5 * self.l2_reg_scale * l2, self.l1_reg_scale * l1],
+                                            name='loss')
+
+                        with jit_scope():
+                            loss = penalized_loss(pred_is)
+
+                            # this is the out-of-sample L2 loss, only for observation, never use for optimization
+                            loss_oos = tf.nn.l2_loss(tf.subtract(y_oos, pred_oos))
 
                     with tf.name_scope('optimizer'):
-                        optimizer = tf.train.AdamOptimizer(learning_rate=adaptive_learning_rate).minimize(loss)
+                        adam = tf.train.AdamOptimizer(learning_rate=adaptive_learning_rate)
+                        self._mixed_precision = False
+                        if self.dtype == tf.float16:
+                            if self.compute_device.find('GPU') == -1:
+                                log.warning("dtype=float16 is not accelerated on CPU, training in float32.")
+                            elif not hasattr(tf.train, 'experimental') or \
+                                    not hasattr(tf.train.experimental, 'MixedPrecisionLossScaleOptimizer'):
+                                log.warning("dtype=float16 needs tensorflow >= 1.14, training in float32.")
+                            else:
+                                # The sessions of this instance turn on the float16 graph rewrite (see
+                                # session_config), which casts X, the RNN and fc1 to float16 where it is
+                                # numerically safe and keeps float32 master weights.  adam gets the dynamic
+                                # loss scaling that keeps the small float16 gradients from underflowing.
+                                # Unlike enable_mixed_precision_graph_rewrite, nothing is switched on for the
+                                # other sessions of the process.
+                                adam = tf.train.experimental.MixedPrecisionLossScaleOptimizer(adam,
+                                                                                              loss_scale='dynamic')
+                                self._mixed_precision = True
+                        optimizer = adam.minimize(loss)
+
+                    with tf.name_scope('inner_iterations'):
+                        # Run n_inner_steps optimization steps on the current batch inside one sess.run.  The
+                        # network and the loss are rebuilt in the loop body on the shared variables, so every
+                        # step sees the weights of the previous one and samples new dropout masks.  adam has
+                        # created its slots in minimize above, none are created inside the loop.
+                        n_inner_steps = tf.placeholder_with_default(0, shape=(), name='n_inner_steps')
+
+                        def inner_step(k):
+                            with jit_scope():
+                                _, _, pred_k = build_network(X)
+                                loss_k = penalized_loss(pred_k[0:in_sample_cutoff, :])
+                            step_k = adam.minimize(loss_k)
+                            with tf.control_dependencies([step_k]):
+                                return k + 1
+
+                        train_n_steps = tf.while_loop(lambda k: k < n_inner_steps, inner_step, [tf.constant(0)],
+                                                      parallel_iterations=1, name='train_n_steps')
 
                     with tf.name_scope('init'):
-                        init = tf.global_variables_initializer()
-
-                    with tf.name_scope('summary'):
-                        tf.summary.tensor_summary("pearson_corr_is", pearson_corr_is)
-                        tf.summary.tensor_summary("pearson_corr_oos", pearson_corr_oos)
-                        tf.summary.scalar("loss", loss)
-                        tf.summary.scalar("validation_loss", loss_oos)
-                        summary_op = tf.summary.merge_all()
-
-                    # Write the graph to summary
-                    try:
-                        writer = tf.summary.FileWriter(self.log_dir, graph=tf.get_default_graph())
-                    except Exception as msg:
-                        writer = None
-                        log.exception("Exception when saving summary info: ", msg)
-
-                    self.model_saver = tf.train.Saver()
+                        init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
+
+                    summary_op = None
+                    writer = None
+                    if verbose >= 1 or self.enable_summaries:
+                        with tf.name_scope('summary'):
+                            tf.summary.scalar("pearson_corr_is", pearson_corr_is)
+                            tf.summary.scalar("pearson_corr_oos", pearson_corr_oos)
+                            tf.summary.scalar("loss", loss)
+                            tf.summary.scalar("validation_loss", loss_oos)
+                            summary_op = tf.summary.merge_all()
+
+                        # Write the graph to summary
+                        try:
+                            writer = tf.summary.FileWriter(self.log_dir, graph=tf.get_default_graph())
+                        except Exception as msg:
+                            log.exception("Exception when saving summary info: ", msg)
+
+                    self.model_saver = tf.train.Saver(max_to_keep=5, save_relative_paths=True)
+
+                    # Last rnn layer weights returned by train(return_weights=True), looked up once here
+                    last_cell = f'rnn/multi_rnn_cell/cell_{self.n_layers-1}'
+                    if self.use_cudnn:
+                        # cuDNN keeps the weights and biases of all the layers in one opaque buffer
+                        weight_names = {f'{self.cell_type.lower()}_opaque_params':
+                                        f'rnn/{multilayer_cell.name}/opaque_kernel:0'}
+                    elif self.cell_type == 'LSTM':
+                        weight_names = dict(lstm_kernel_weights=f'{last_cell}/lstm_cell/kernel:0',
+                                            lstm_kernel_biases=f'{last_cell}/lstm_cell/bias:0')
+                    elif self.cell_type == 'GRU':
+                        weight_names = dict(gru_gates_weights=f'{last_cell}/gru_cell/gates/kernel:0',
+                                            gru_gates_biases=f'{last_cell}/gru_cell/gates/bias:0',
+                                            gru_candidate_weights=f'{last_cell}/gru_cell/candidate/kernel:0',
+                                            gru_candidate_biases=f'{last_cell}/gru_cell/candidate/bias:0')
+                    else:
+                        weight_names = dict(rnn_kernel_weights=f'{last_cell}/basic_rnn_cell/kernel:0',
+                                            rnn_kernel_biases=f'{last_cell}/basic_rnn_cell/bias:0')
+                    self._weight_tensors = dict()
+                    for key, name in weight_names.items():
+                        try:
+                            self._weight_tensors[key] = self.graph.get_tensor_by_name(name)
+                        except KeyError:
+                            log.warning(f"{name} is not in the graph, {key} will not be returned.")
 
                     # Group all the keys into a dictionary by using kwargs
                     self.graph_keys = dict(
@@ -511,14 +917,29 @@ class LSTM:
                         pred=pred,
                         pred_is=pred_is,
                         pred_oos=pred_oos,
-                        keep_prob=keep_prob,
+                        y_mean=y_mean,
+                        y_std=y_std,
+                        y_out=y_out,
+                        pred_out=pred_out,
+                        y_oos_out=y_oos_out,
+                        pred_oos_out=pred_oos_out,
+                        is_training=is_training,
+                        n_repeats=n_repeats,
+                        data_iterator=data_iterator,
+                        stage_put=stage_put,
                         in_sample_cutoff=in_sample_cutoff,
                         global_step=global_step,
+                        progress=progress,
+                        set_global_step=set_global_step,
                         states=states,
                         outputs=outputs,
+                        W_fc1=W_fc1,
+                        b_fc1=b_fc1,
                         loss=loss,
                         loss_oos=loss_oos,
                         optimizer=optimizer,
+                        n_inner_steps=n_inner_steps,
+                        train_n_steps=train_n_steps,
                         pearson_corr_is=pearson_corr_is,
                         pearson_corr_oos=pearson_corr_oos,
                         adaptive_learning_rate=adaptive_learning_rate,
@@ -542,9 +963,151 @@ class LSTM:
         self.cell_states = dict()  # dictionary holding the last layer rnn cell states
         self.fc_states = dict()  # dictionary holding the rnn to output fc layer states
 
+    def latest_checkpoint(self):
+        """Path of the most recent checkpoint saved by the current session."""
+        path = tf.train.latest_checkpoint(self.model_dir, latest_filename=f"{self.sessid}_checkpoint")
+        if path is None:
+            # saved before the per session checkpoint state file was kept
+            path = os.path.join(self.model_dir, f"{self.sessid}_latest.ckpt")
+        return path
+
+    def session_config(self, log=None, verbose=0, precision=None):
+        """Return the tf.ConfigProto used by the training and prediction sessions.
+        The config is built once and shared by all the sessions of the instance.  Device placement is only logged
+        with verbose >= 3, since it logs every node of the graph.
+        precision: tf.float16 turns on the auto mixed precision rewrite of the session on GPU, which runs the
+        matmuls and element-wise ops in float16 and keeps float32 where it is numerically unsafe.  None follows
+        the dtype of the instance, tf.float32 turns the rewrite off.
+        """
+        if log is None:
+            log = logger
+
+        assert not getattr(tf, 'executing_eagerly', lambda: False)(), \
+            "eager execution is enabled, the LSTM graph has to run in graph mode"
+        if self._sess_config is None:
+            # intra-op threads run the kernels (matmuls, element-wise ops) over all the cores, the few inter-op
+            # threads run independent ops side by side without oversubscribing them.
+            config = tf.ConfigProto(intra_op_parallelism_threads=os.cpu_count() or 0,
+                                    inter_op_parallelism_threads=2,
+                                    allow_soft_placement=True, log_device_placement=False)
+            if self.compute_device.find('CPU') != -1:
+                config.device_count['GPU'] = 0
+            else:
+                # Grow the GPU memory as needed instead of grabbing all of it, so several processes can share a GPU
+                config.gpu_options.allow_growth = True
+            if self.use_xla:
+                # Let XLA cluster and fuse the many small element-wise ops of the graph (cell gates, dropout,
+                # regularizer and pearson stats) into a handful of kernels.  The jit level only clusters GPU ops,
+                # on CPU the ops marked by the jit_scope of create_lstm_graph are compiled.  Both are per session,
+                # other instances of the process are not affected.
+                config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+            self._sess_config = config
+
+        if precision is None:
+            # a float16 instance runs its training graph with the float16 rewrite, see create_lstm_graph
+            precision = tf.float16 if self._mixed_precision else tf.float32
+        precision = tf.as_dtype(precision)
+        if verbose < 3 and precision == tf.float32:
+            return self._sess_config
+
+        config = tf.ConfigProto()
+        config.CopyFrom(self._sess_config)
+        config.log_device_placement = verbose >= 3
+        if precision == tf.float32:
+            pass
+        elif precision == tf.float16:
+            # float16 kernels are only fast on the GPU tensor cores, the rewrite leaves the graph alone on CPU
+            if self.compute_device.find('GPU') == -1:
+                log.warning("precision float16 is not accelerated on CPU, running in float32.")
+            else:
+                try:
+                    config.graph_options.rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+                except (AttributeError, ValueError):
+                    log.warning("precision float16 needs tensorflow >= 1.14, running in float32.")
+        else:
+            # the bfloat16 rewrite only exists from tensorflow 2.3, which has no tf.contrib this module needs
+            raise ValueError("precision must be tf.float32 or tf.float16, got %s" % precision.name)
+        return config
+
+    def _batch_generator(self):
+        """Run the data_feeder being trained on for the tf.data input pipeline.
+        Yields X, y, in_sample_size, y_is_mean and y_is_std (as float32 arrays) of every usable batch.
+        The rest of the batch (y_is_mean, y_is_std, the index, in_sample_size, the batch size, the batch id and
+        whether it is the last batch) is queued in self._batch_info, in the same order.
+        """
+        pending = None  # each batch is held back until the next one is found, to know which one is the last
+        for batch_X, batch_y, y_is_mean, y_is_std, batch_y_index, in_sample_size, batch_id in self._train_feeder():
+            total_sample_size = batch_X.shape[0]
+            if not (np.isfinite(batch_X).all() and np.isfinite(batch_y).all()):
+                continue
+            assert in_sample_size <= total_sample_size, "in_sample_size needs to be smaller than total"
+            assert self.fixed_cutoff is None or in_sample_size == self.fixed_cutoff, \
+                "in_sample_size has to match the fixed_cutoff the graph was built with"
+            assert batch_X.shape[2] == self.n_input_features, \
+                "batch_X should have shape [batch_size, n_time_steps, n_input_features]"
+            assert batch_y.shape[1] == self.n_output_features, \
+                "batch_y should have shape [batch_size, n_output_features]"
+            if pending is not None:
+                batch, info = pending
+                self._batch_info.append(info + (False,))
+                yield batch
+            pending = (
+                (aligned_float32(batch_X), aligned_float32(batch_y), in_sample_size,
+                 np.asarray(y_is_mean, dtype=np.float32), np.asarray(y_is_std, dtype=np.float32)),
+                (y_is_mean, y_is_std, batch_y_index, in_sample_size, total_sample_size, batch_id)
+            )
+        if pending is not None:
+            batch, info = pending
+            self._batch_info.append(info + (True,))
+            yield batch
+
+    def make_train_step(self, sess, fetch_metrics=False, fetch_summary=False, fetch_states=False, stage_next=True):
+        """Wrap the optimization steps into a callable bound to sess.
+        The fetches and feeds are resolved once by Session.make_callable instead of at every sess.run, which
+        saves the Python side overhead of the training loop.
+        By default the callable runs n_steps optimization steps in the graph on the next batch, in a single call.
+        With fetch_metrics=True it runs one step and also returns y, pred, y_oos, pred_oos (reverse transformed
+        with y_is_mean and y_is_std of the batch), pearson_corr_is, pearson_corr_oos, loss, loss_oos, then the
+        summary with fetch_summary=True if summaries are on and the rnn states with fetch_states=True, all taken
+        from the forward pass of the step itself.
+        On GPU the call also stages the next batch, unless stage_next=False for the very last step of an epoch.
+        Each call takes the next batch from the input pipeline, which raises tf.errors.OutOfRangeError at its end.
+        Usage:: train_step(n_steps)
+                optimizer_val, learning_rate_val, y_val, ... = train_eval_step()
+        """
+        if fetch_metrics:
+            fetches = [
+                self.graph_keys['optimizer'],
+                self.graph_keys['adaptive_learning_rate'],
+                self.graph_keys['y_out'],
+                self.graph_keys['pred_out'],
+                self.graph_keys['y_oos_out'],
+                self.graph_keys['pred_oos_out'],
+                self.graph_keys['pearson_corr_is'],
+                self.graph_keys['pearson_corr_oos'],
+                self.graph_keys['loss'],
+                self.graph_keys['loss_oos']
+            ]
+            if fetch_summary and self.graph_keys['summary_op'] is not None:
+                fetches.append(self.graph_keys['summary_op'])
+            if fetch_states:
+                fetches.append(self.graph_keys['states'])
+        else:
+            fetches = [self.graph_keys['train_n_steps']]
+        if stage_next and self.graph_keys['stage_put'] is not None:
+            fetches.append(self.graph_keys['stage_put'])
+        # X, y and in_sample_cutoff come from the input pipeline, only the training flag and step count are fed
+        if fetch_metrics:
+            step = sess.make_callable(fetches, feed_list=[self.graph_keys['is_training']])
+            return lambda: step(True)
+        step = sess.make_callable(fetches, feed_list=[self.graph_keys['is_training'],
+                                                      self.graph_keys['n_inner_steps']])
+        return lambda n_steps: step(True, n_steps)
+
     def train(self, batch_X=None, batch_y=None, in_sample_size=None, y_is_mean=0.0, y_is_std=1.0, data_feeder=None,
               restore_model=True, pre_trained_model=None, epoch_prev=0, epoch_end=21, inner_iteration=None,
-              step=1, writer_step=1, display_step=50, return_weights=False, log=None, verbose=0):
+              step=1, writer_step=1, display_step=50, return_weights=False, save_every_n_epochs=1,
+              log=None, verbose=0):
         """Perform training of the LSTM network on specified compute device.
         There are two ways of feeding in data:
 
@@ -556,6 +1119,10 @@ class LSTM:
         Model persistence:
             Model persistence is also built into the class.  As long as model_saver and model_dir are
             properly setup, they
+            One checkpoint is written at the end of every epoch: {sessid}_epoch_{i}.ckpt every
+            save_every_n_epochs epochs and for the last epoch, {sessid}_latest.ckpt otherwise.  The files of an
+            epoch checkpoint are also linked as {sessid}_latest.ckpt, so it always holds the newest weights.
+            The saver keeps the 5 most recent checkpoints.
 
         Return: A compiled dictionary of various outputs from training.
         """
@@ -569,14 +1136,21 @@ class LSTM:
         # If batch data are specifically provided, it will take priority over data_feeder
         if batch_X is not None and batch_y is not None and in_sample_size is not None \
                 and y_is_mean is not None and y_is_std is not None:
+            direct_batches = [(batch_X, batch_y, y_is_mean, y_is_std, None, in_sample_size, 0)]
+
             def data_feeder():
-                return [(batch_X, batch_y, y_is_mean, y_is_std, in_sample_size, total_sample_size)]
+                return direct_batches
+
+        # if inner_iteration is passed in, then it takes priority over internal state
+        if inner_iteration is None:
+            inner_iteration = self.inner_iteration
+        assert isinstance(inner_iteration, int) and inner_iteration >= 1, "inner_iteration has to be >= 1"
+        self._train_feeder = data_feeder
+        # rows reserved for the per batch metrics of an epoch, a data_feeder with __len__ tells the batch count
+        batch_capacity = max(len(data_feeder), 1) if hasattr(data_feeder, '__len__') else 64
 
         # Launch a tensorflow compute session
-        if self.compute_device.find('CPU') != -1:
-            config = tf.ConfigProto(device_count={'GPU': 0}, allow_soft_placement=True, log_device_placement=True)
-        else:
-            config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=True)
+        config = self.session_config(log=log, verbose=verbose)
         with tf.Session(graph=self.graph, config=config) as sess:
             # Restore latest checkpoint
             if restore_model:
@@ -595,7 +1169,7 @@ class LSTM:
                     i = self.trained_epochs + 1
                     assert self.sessid is not None
                     try:
-                        self.model_saver.restore(sess, os.path.join(self.model_dir, f"{self.sessid}_latest.ckpt"))
+                        self.model_saver.restore(sess, self.latest_checkpoint())
                     except Exception as msg:
                         log.exception("Active session restore failed: ", msg)
                         raise Exception
@@ -616,182 +1190,123 @@ class LSTM:
                 self.logging_session_parameters()
                 i = epoch_prev + 1  # set epoch counter
 
+            train_step = self.make_train_step(sess)
+            # (fetch_summary, stage_next) -> metrics step, the summary is only serialized on display steps
+            # the rnn states are only fetched for the debug output of verbose >= 3
+            eval_steps = {
+                (fetch_summary, stage_next): self.make_train_step(sess, fetch_metrics=True, fetch_summary=fetch_summary,
+                                                                  fetch_states=verbose >= 3, stage_next=stage_next)
+                for fetch_summary in (False, True) for stage_next in (False, True)
+            }
+            # the graph tensors used in the epoch and batch loops, looked up once
+            stage_put = self.graph_keys['stage_put']
+            set_global_step = self.graph_keys['set_global_step']
+            progress = self.graph_keys['progress']
+            data_iterator = self.graph_keys['data_iterator']
+            n_repeats = self.graph_keys['n_repeats']
+            writer = self.graph_keys['writer']
+            has_summary = self.graph_keys['summary_op'] is not None
+            fc_weights = [self.graph_keys['W_fc1'], self.graph_keys['b_fc1']]
+
+            latest_path = os.path.join(self.model_dir, f"{self.sessid}_latest.ckpt")
+
+            def save_checkpoint(checkpoint_name):
+                try:
+                    # _latest may be linked to the files of an epoch checkpoint, which must not be written through
+                    for file_name in glob.glob(f"{glob.escape(latest_path)}.*"):
+                        os.remove(file_name)
+                    path = self.model_saver.save(sess, os.path.join(self.model_dir, checkpoint_name),
+                                                 latest_filename=f"{self.sessid}_checkpoint")
+                    if path != latest_path:
+                        # keep _latest restorable by name without saving the variables a second time
+                        for file_name in glob.glob(f"{glob.escape(path)}.*"):
+                            latest_file_name = latest_path + file_name[len(path):]
+                            try:
+                                os.link(file_name, latest_file_name)
+                            except OSError:
+                                shutil.copyfile(file_name, latest_file_name)
+                    log.info("Model checkpoint successfully saved.")
+                except Exception:
+                    log.info("Model checkpoint save unsuccessful")
+
             while i <= epoch_end:
                 log.info(f"[{self.sessid}] Epoch {i} Starts ******************************************************")
                 tic = time()
-                actual_oos = None  # resets for each epoch
-                predicted_oos = None
-                loss_epoch = 0.0
-                loss_oos_epoch = 0.0  # validation set loss
-
-                for batch_X, batch_y, y_is_mean, y_is_std, batch_y_index, in_sample_size, batch_id in data_feeder():
-                    total_sample_size = batch_X.shape[0]
-                    if np.isfinite(batch_X).sum() != batch_X.size or \
-                       np.isfinite(batch_y).sum() != batch_y.size:
-                        continue
-                    assert np.isfinite(y_is_mean).sum() == y_is_mean.size
-                    assert np.isfinite(y_is_std).sum() == y_is_std.size
-                    assert in_sample_size <= total_sample_size, "in_sample_size needs to be smaller than total"
-                    assert batch_X.shape[2] == self.n_input_features, \
-                        "batch_X should have shape [batch_size, n_time_steps, n_input_features]"
-                    assert batch_y.shape[1] == self.n_output_features, \
-                        "batch_y should have shape [batch_size, n_output_features]"
-
-                    # if inner_iteration is passed in, then it takes priority over internal state
-                    if inner_iteration is None:
-                        inner_iteration = self.inner_iteration
-                    assert isinstance(inner_iteration, int) and inner_iteration >= 1, "inner_iteration has to be >= 1"
-
+                actual_oos_chunks = []  # resets for each epoch
+                predicted_oos_chunks = []
+                actual_is_chunks = []
+                predicted_is_chunks = []
+                # pearson_corr_is, pearson_corr_oos, loss and validation set loss of every batch
+                batch_metrics = np.empty((batch_capacity, 4), dtype=np.float64)
+                batch_idx = 0
+                # global_step/decay_steps goes from 0 to 1 through the training epochs
+                sess.run(set_global_step, feed_dict={progress: i / epoch_end})
+                # restart the input pipeline on the data_feeder
+                self._batch_info.clear()
+                # one copy of each batch for the in-graph steps and one for the step fetching the metrics
+                sess.run(data_iterator.initializer, feed_dict={n_repeats: min(inner_iteration, 2)})
+                batch_ready = True
+                if stage_put is not None:
+                    # warm up the StagingArea with the first batch, getting from an empty stage would block
+                    try:
+                        sess.run(stage_put)
+                    except tf.errors.OutOfRangeError:
+                        batch_ready = False
+
+                while batch_ready:
+                    fetch_summary = has_summary and step % display_step == 0
+                    stage_next = True
+                    if stage_put is not None and self._batch_info[0][-1]:
+                        # nothing is left to stage after the last step of the last batch
+                        stage_next = False
+                        batch_ready = False
+                    eval_step = eval_steps[(fetch_summary, stage_next)]
                     # Run optimization
                     # Note: dropout is intended for training only
-                    for _ in range(inner_iteration):
-                        _, current_rate, states_val = sess.run(
-                            [
-                                self.graph_keys['optimizer'],
-                                self.graph_keys['adaptive_learning_rate'],
-                                self.graph_keys['states']
-                            ],
-                            feed_dict={
-                                self.graph_keys['X']: batch_X,
-                                self.graph_keys['y']: batch_y,
-                                self.graph_keys['keep_prob']: self.keep_prob,  # for training only
-                                self.graph_keys['in_sample_cutoff']: in_sample_size,
-                                self.graph_keys['global_step']: i / epoch_end
-                            }
-                        )
-                    if verbose >= 3:  # DEBUG
-                        print("states_val", states_val)
-                    # Obtain out of sample target variable and prediction
-                    y_val, pred_val, y_oos_val, pred_oos_val, \
-                        pearson_corr_is_val, pearson_corr_oos_val, loss_val, loss_oos_val, summary = sess.run(
-                        [
-                            self.graph_keys['y'],
-                            self.graph_keys['pred'],
-                            self.graph_keys['y_oos'],
-                            self.graph_keys['pred_oos'],
-                            self.graph_keys['pearson_corr_is'],
-                            self.graph_keys['pearson_corr_oos'],
-                            self.graph_keys['loss'],
-                            self.graph_keys['loss_oos'],
-                            self.graph_keys['summary_op']
-                        ],
-                            feed_dict={
-                            self.graph_keys['X']: batch_X,
-                            self.graph_keys['y']: batch_y,
-                            self.graph_keys['keep_prob']: 1.0,  # needs to be 1.0 for prediction
-                            self.graph_keys['in_sample_cutoff']: in_sample_size
-                        }
-                    )
+                    try:
+                        if inner_iteration > 1:
+                            train_step(inner_iteration - 1)
+                        # The last step also fetches the predictions and metrics off its own forward pass, so the
+                        # batch is not fed and run through the network a second time just for the evaluation.
+                        step_results = eval_step()
+                    except tf.errors.OutOfRangeError:
+                        break  # data_feeder is exhausted
+                    y_is_mean, y_is_std, batch_y_index, in_sample_size, total_sample_size, batch_id, _ = \
+                        self._batch_info.popleft()
+                    _, current_rate, y_val, pred_val, y_oos_val, pred_oos_val, \
+                        pearson_corr_is_val, pearson_corr_oos_val, loss_val, loss_oos_val = step_results[:10]
+                    summary = step_results[10] if fetch_summary else None
                     if verbose >= 3:  # DEBUG
+                        print("states_val", step_results[11 if fetch_summary else 10])
                         print("y_val", y_val)
                         print("pred_val", pred_val)
-                    assert (y_val[in_sample_size:, ] == y_oos_val).all(), \
-                        "y_val and y_oos_val fails, likely nan."
-                    assert (pred_val[in_sample_size:, ] == pred_oos_val).all(), \
-                        "pred_val and pred_oos_val fails, likely nan."
+                        # y_oos and pred_oos are slices of y and pred in the graph, only check them when debugging
+                        assert (y_val[in_sample_size:, ] == y_oos_val).all(), \
+                            "y_val and y_oos_val fails, likely nan."
+                        assert (pred_val[in_sample_size:, ] == pred_oos_val).all(), \
+                            "pred_val and pred_oos_val fails, likely nan."
 
-                    # reverse transform before recording the results
+                    # y_val, pred_val, y_oos_val and pred_oos_val are already reverse transformed in the graph
                     # if no reverse transform is desired inside training, use default y_is_mean=0.0 and y_is_std=1.0
-                    y_val = np.array(y_val) * y_is_std + y_is_mean
-                    y_oos_val = np.array(y_oos_val) * y_is_std + y_is_mean
-                    pred_val = np.array(pred_val) * y_is_std + y_is_mean
-                    pred_oos_val = np.array(pred_oos_val) * y_is_std + y_is_mean
-
-                    # record the results
-                    if actual_oos is None:
-                        actual_oos = np.array(y_oos_val)
-                    else:
-                        actual_oos = np.r_[actual_oos, np.array(y_oos_val)]
-
-                    if predicted_oos is None:
-                        predicted_oos = np.array(pred_oos_val)
-                    else:
-                        predicted_oos = np.r_[predicted_oos, np.array(pred_oos_val)]
-
-                    if self.all_actual_is is None:
-                        self.all_actual_is = np.array(y_val[0:in_sample_size, :])
-                    else:
-                        self.all_actual_is = np.r_[self.all_actual_is, np.array(y_val[0:in_sample_size, :])]
-
-                    if self.all_actual_oos is None:
-                        self.all_actual_oos = np.array(y_oos_val)
-                    else:
-                        self.all_actual_oos = np.r_[self.all_actual_oos, np.array(y_oos_val)]
-
-                    if self.all_predicted_is is None:
-                        self.all_predicted_is = np.array(pred_val[0:in_sample_size, :])
-                    else:
-                        self.all_predicted_is = np.r_[self.all_predicted_is, np.array(pred_val[0:in_sample_size, :])]
-
-                    if self.all_predicted_oos is None:
-                        self.all_predicted_oos = np.array(pred_oos_val)
-                    else:
-                        self.all_predicted_oos = np.r_[self.all_predicted_oos, np.array(pred_oos_val)]
-
-                    pearson_corr_is_val = np.diagonal(pearson_corr_is_val).mean()  # Taking the mean of all outputs
-                    pearson_corr_oos_val = np.diagonal(pearson_corr_oos_val).mean()  # Taking the mean of all outputs
-
-                    self.all_corr_is.append(pearson_corr_is_val)
-                    self.all_corr_oos.append(pearson_corr_oos_val)
-                    loss_epoch += loss_val
-                    loss_oos_epoch += loss_oos_val
 
-                    if return_weights:
-                        if self.cell_type == 'LSTM':
-                            lstm_kernel_weights = self.graph.get_tensor_by_name(
-                                f'rnn/multi_rnn_cell/cell_{self.n_layers-1}/lstm_cell/kernel:0'
-                            )
-                            lstm_kernel_biases = self.graph.get_tensor_by_name(
-                                f'rnn/multi_rnn_cell/cell_{self.n_layers-1}/lstm_cell/bias:0'
-                            )
-                            self.cell_states['lstm_kernel_weights'] = lstm_kernel_weights.eval()
-                            self.cell_states['lstm_kernel_biases'] = lstm_kernel_biases.eval()
+                    # record the results, they are concatenated once at the end of the epoch
+                    actual_oos_chunks.append(y_oos_val)
+                    predicted_oos_chunks.append(pred_oos_val)
+                    actual_is_chunks.append(y_val[0:in_sample_size, :])
+                    predicted_is_chunks.append(pred_val[0:in_sample_size, :])
 
-                        elif self.cell_type == 'GRU':
-                            gru_gates_weights = self.graph.get_tensor_by_name(
-                                f'rnn/multi_rnn_cell/cell_{self.n_layers-1}/gru_cell/gates/kernel:0'
-                            )
-                            gru_gates_biases = self.graph.get_tensor_by_name(
-                                f'rnn/multi_rnn_cell/cell_{self.n_layers-1}/gru_cell/gates/bias:0'
-                            )
-                            gru_candidate_weights = self.graph.get_tensor_by_name(
-                                f'rnn/multi_rnn_cell/cell_{self.n_layers-1}/gru_cell/candidate/kernel:0'
-                            )
-                            gru_candidate_biases = self.graph.get_tensor_by_name(
-                                f'rnn/multi_rnn_cell/cell_{self.n_layers-1}/gru_cell/candidate/bias:0'
-                            )
-                            self.cell_states['gru_gates_weights'] = gru_gates_weights.eval()
-                            self.cell_states['gru_gates_biases'] = gru_gates_biases.eval()
-                            self.cell_states['gru_candidate_weights'] = gru_candidate_weights.eval()
-                            self.cell_states['gru_candidate_biases'] = gru_candidate_biases.eval()
-
-                        elif self.cell_type == 'RNN':
-                            rnn_kernel_weights = self.graph.get_tensor_by_name(
-                                f'rnn/multi_rnn_cell/cell_{self.n_layers-1}/basic_rnn_cell/kernel:0'
-                            )
-                            rnn_kernel_biases = self.graph.get_tensor_by_name(
-                                f'rnn/multi_rnn_cell/cell_{self.n_layers-1}/basic_rnn_cell/bias:0'
-                            )
-                            self.cell_states['rnn_kernel_weights'] = rnn_kernel_weights.eval()
-                            self.cell_states['rnn_kernel_biases'] = rnn_kernel_biases.eval()
-                        else:
-                            assert False
-
-                        # fully-connected layer between last rnn cell to output
-                        fc_weights = self.graph.get_tensor_by_name(
-                            f'{self.scope}/model/fc1/W/W_fc1:0'
-                        )
-                        fc_biases = self.graph.get_tensor_by_name(
-                            f'{self.scope}/model/fc1/b/b_fc1:0'
-                        )
-                        self.fc_states['weights'] = fc_weights.eval()
-                        self.fc_states['biases'] = fc_biases.eval()
+                    if batch_idx == len(batch_metrics):
+                        # more batches than reserved, double the rows
+                        batch_metrics = np.concatenate([batch_metrics, np.empty_like(batch_metrics)])
+                    batch_metrics[batch_idx] = pearson_corr_is_val, pearson_corr_oos_val, loss_val, loss_oos_val
+                    batch_idx += 1
 
                     # Once every display_step show some diagnostics - the loss function, in-sample correlation, etc.
                     if step % display_step == 0:
                         #                 print("add writer step to summary")
-                        self.graph_keys['writer'].add_summary(summary, writer_step)
-                        writer_step += 1
+                        if summary is not None and writer is not None:
+                            writer.add_summary(summary, writer_step)
+                            writer_step += 1
                         toc = time() - tic
                         log.info(
                             f"[{self.sessid}] Iter:{step}, LR:{current_rate:.5f}, mbatch_id: {batch_id}, "
@@ -802,19 +1317,46 @@ class LSTM:
                     step += 1  # finishes this id, continue to next id step
 
                 # epoch finishes
+                batch_metrics = batch_metrics[:batch_idx]
+                self.all_corr_is.extend(batch_metrics[:, 0].tolist())
+                self.all_corr_oos.extend(batch_metrics[:, 1].tolist())
+                loss_epoch, loss_oos_epoch = np.add.reduce(batch_metrics[:, 2:], axis=0).tolist()
+                actual_oos = np.concatenate(actual_oos_chunks, axis=0)
+                predicted_oos = np.concatenate(predicted_oos_chunks, axis=0)
+                if self.all_actual_is is not None:
+                    actual_is_chunks.insert(0, self.all_actual_is)
+                    predicted_is_chunks.insert(0, self.all_predicted_is)
+                    actual_oos_chunks.insert(0, self.all_actual_oos)
+                    predicted_oos_chunks.insert(0, self.all_predicted_oos)
+                self.all_actual_is = np.concatenate(actual_is_chunks, axis=0)
+                self.all_predicted_is = np.concatenate(predicted_is_chunks, axis=0)
+                self.all_actual_oos = np.concatenate(actual_oos_chunks, axis=0)
+                self.all_predicted_oos = np.concatenate(predicted_oos_chunks, axis=0)
                 assert actual_oos.shape == predicted_oos.shape
                 if verbose >= 2:
                     print("actual shape: ", actual_oos.shape)
                     print("predicted shape: ", predicted_oos.shape)
 
-                corr_epoch = []
-                for j in range(actual_oos.shape[1]):  # loop through n_output_features
-                    corr_epoch.append(np.corrcoef(actual_oos[:, j], predicted_oos[:, j])[0, 1])
-                corr_epoch_oos = np.array(corr_epoch).mean()
+                # pearson correlation of every output column at once, then averaged over n_output_features
+                centered_actual = actual_oos - actual_oos.mean(axis=0)
+                centered_predicted = predicted_oos - predicted_oos.mean(axis=0)
+                corr_epoch = (centered_actual * centered_predicted).sum(axis=0) / np.sqrt(
+                    (centered_actual * centered_actual).sum(axis=0) *
+                    (centered_predicted * centered_predicted).sum(axis=0)
+                )
+                corr_epoch_oos = corr_epoch.mean()
 
                 if verbose >= 2:
                     print(corr_epoch_oos)
 
+                if return_weights:
+                    # a single run for all the weights, once per epoch since only the latest values are kept
+                    weight_keys = list(self._weight_tensors)
+                    weight_vals = sess.run([self._weight_tensors[key] for key in weight_keys] + fc_weights)
+                    self.cell_states.update(zip(weight_keys, weight_vals[:-2]))
+                    # fully-connected layer between last rnn cell to output
+                    self.fc_states['weights'], self.fc_states['biases'] = weight_vals[-2:]
+
                 self.all_epochs.append(i)
                 self.all_losses_per_epoch.append(loss_epoch)
                 self.all_losses_oos_per_epoch.append(loss_oos_epoch)
@@ -826,12 +1368,10 @@ class LSTM:
                 log.info(
                     f"[{self.sessid}] Epoch {i} Ends ======================================================"
                 )
-                try:
-                    _ = self.model_saver.save(sess, os.path.join(self.model_dir, f"{self.sessid}_epoch_{i}.ckpt"))
-                    _ = self.model_saver.save(sess, os.path.join(self.model_dir, f"{self.sessid}_latest.ckpt"))
-                    log.info("Model checkpoint successfully saved.")
-                except Exception:
-                    log.info("Model checkpoint save unsuccessful")
+                if i % save_every_n_epochs == 0 or i == epoch_end:
+                    save_checkpoint(f"{self.sessid}_epoch_{i}.ckpt")
+                else:
+                    save_checkpoint(f"{self.sessid}_latest.ckpt")
                 i += 1  # onto next epoch
 
             self.graph_trained = True  # indicating the current graph has been trained in the active session
@@ -860,10 +1400,15 @@ class LSTM:
             return results
     # end train
 
-    def predict(self, batch_X=None, data_feeder=None, pre_trained_model=None, log=None):
+    def predict(self, batch_X=None, data_feeder=None, pre_trained_model=None, predict_dtype=None, log=None,
+                verbose=0):
         """Use trained model or restore from pre-trained model to predict
         Note: if a generator is passed in, the tensorflow Session will hold resources active until iterating
         through the entire iterable dataset.
+        The batches are run on a background thread up to 2 batches ahead of the consumer, so the session computes
+        the next predictions while the caller is still processing the previous ones.
+        predict_dtype: tf.float16 runs the forward pass in reduced precision on GPU, the restored float32 weights
+        are cast by the session's graph rewrite.  tf.float32 turns it off, None follows the dtype of the instance.
         Return/Yield: predicted values
         """
         if log is None:
@@ -880,10 +1425,7 @@ class LSTM:
                 return [batch_X]
 
         # Launch a tensorflow compute session
-        if self.compute_device.find('CPU') != -1:
-            config = tf.ConfigProto(device_count={'GPU': 0}, allow_soft_placement=True, log_device_placement=True)
-        else:
-            config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=True)
+        config = self.session_config(log=log, verbose=verbose, precision=predict_dtype)
         with tf.Session(graph=self.graph, config=config) as sess:
             # Restore latest checkpoint
             if pre_trained_model is not None:
@@ -901,34 +1443,76 @@ class LSTM:
                     "No valid session id (sessid) from training in this active session. "\
                     "Alternatively, you may try restoring a previously trained model specifically."
                 # Restore graph variables from training using default model persistence
-                self.model_saver.restore(sess, os.path.join(self.model_dir, f"{self.sessid}_latest.ckpt"))
+                self.model_saver.restore(sess, self.latest_checkpoint())
             self.logging_session_parameters()
 
-            for data in data_feeder():
-                # In the case that training feeder is used to feed data, we only take the first input, batch_X
-                if isinstance(data, tuple):
-                    batch_X, batch_y, y_mean, y_astd, y_index, in_sample_size, this_gvkey = data
-                else:
-                    batch_X = data
-                    batch_y, y_mean, y_astd, y_index, in_sample_size, this_gvkey = None, None, None, None, None, None
-
-                total_sample_size = batch_X.shape[0]
-                # Obtain out of sample target variable and prediction
-                pred_val = sess.run(
-                    [
-                        self.graph_keys['pred'],
-                    ],
-                    feed_dict={
-                        self.graph_keys['X']: batch_X,
-                        self.graph_keys['keep_prob']: 1.0,  # needs to be 1.0 for prediction
-                        self.graph_keys['in_sample_cutoff']: total_sample_size
-                    }
-                )
-                # log.info(f'[{self.sessid}] Prediction run successful.')
+            pred_out = self.graph_keys['pred_out']
+            X = self.graph_keys['X']
+            y_mean_ph = self.graph_keys['y_mean']
+            y_std_ph = self.graph_keys['y_std']
+            predictions = queue.Queue(maxsize=2)
+            done = object()  # end of data_feeder sentinel
+            stop = threading.Event()  # set when the consumer closes the generator early
+
+            def put(item):
+                # never blocks for good on a full queue the consumer has stopped reading from
+                while not stop.is_set():
+                    try:
+                        predictions.put(item, timeout=0.1)
+                        return True
+                    except queue.Full:
+                        continue
+                return False
+
+            def produce():
+                try:
+                    for data in data_feeder():
+                        # In the case that training feeder is used to feed data, we only take the first input, batch_X
+                        if isinstance(data, tuple):
+                            batch_X, batch_y, y_mean, y_astd, y_index, in_sample_size, this_gvkey = data
+                        else:
+                            batch_X = data
+                            batch_y, y_mean, y_astd, y_index, in_sample_size, this_gvkey = \
+                                None, None, None, None, None, None
 
-                batch_y = batch_y * y_astd + y_mean
-                pred_val = np.array(pred_val) * y_astd + y_mean
-                yield pred_val, batch_X, batch_y, y_mean, y_astd, y_index, this_gvkey
+                        # Obtain out of sample target variable and prediction, reverse transformed in the graph
+                        pred_val = sess.run(
+                            [
+                                pred_out,
+                            ],
+                            feed_dict={
+                                X: aligned_float32(batch_X),  # is_training defaults to False, no dropout
+                                y_mean_ph: np.asarray(0.0 if y_mean is None else y_mean, dtype=np.float32),
+                                y_std_ph: np.asarray(1.0 if y_astd is None else y_astd, dtype=np.float32)
+                            }
+                        )
+                        # log.info(f'[{self.sessid}] Prediction run successful.')
+
+                        if batch_y is not None:
+                            batch_y = batch_y * y_astd + y_mean
+                        pred_val = np.array(pred_val)
+                        if not put((pred_val, batch_X, batch_y, y_mean, y_astd, y_index, this_gvkey)):
+                            return
+                except Exception as err:
+                    # re-raised in the consumer
+                    put(err)
+                    return
+                put(done)
+
+            producer = threading.Thread(target=produce, name=f"{self.sessid}_predict", daemon=True)
+            producer.start()
+            try:
+                while True:
+                    item = predictions.get()
+                    if item is done:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                # the session has to stay open until the producer is done with it
+                stop.set()
+                producer.join()
     # end predict
 
 
@@ -14,12 +14,13 @@ def visualize_results(g, results, save_figure=False, save_path='results'):
         g: a LSTM or GRU or RNN instance after training
         results: returned results from training
     """
+    # the kernels are not available when the weights live in the opaque cuDNN parameter buffer
     if g.cell_type == 'LSTM':
-        kernel_weights = results['cell_states']['lstm_kernel_weights']
+        kernel_weights = results['cell_states'].get('lstm_kernel_weights')
     elif g.cell_type == 'GRU':
-        kernel_weights = results['cell_states']['gru_candidate_weights']
+        kernel_weights = results['cell_states'].get('gru_candidate_weights')
     elif g.cell_type == 'RNN':
-        kernel_weights = results['cell_states']['rnn_kernel_weights']
+        kernel_weights = results['cell_states'].get('rnn_kernel_weights')
     else:
         assert False
     fc_weights = results['fc_states']['weights']
@@ -77,13 +78,14 @@ def visualize_results(g, results, save_figure=False, save_path='results'):
     plt.tight_layout()
 
     # Visualization of LSTM cell internal weights
-    plt.figure(figsize=(24, 6));
-    # cmap = sns.diverging_palette(250, 5, sep=1, as_cmap=True)
-    sns.heatmap(kernel_weights, center=0, cmap="bwr", xticklabels=10, yticklabels=10);
-    # sns.heatmap(kernel_weights, vmin=-2.0, vmax=2.0, center=0, cmap="bwr", xticklabels=10, yticklabels=10);
-    plt.tight_layout();
-    if save_figure:
-        plt.savefig(os.path.join(save_path, 'kernel_weights.png'))
+    if kernel_weights is not None:
+        plt.figure(figsize=(24, 6));
+        # cmap = sns.diverging_palette(250, 5, sep=1, as_cmap=True)
+        sns.heatmap(kernel_weights, center=0, cmap="bwr", xticklabels=10, yticklabels=10);
+        # sns.heatmap(kernel_weights, vmin=-2.0, vmax=2.0, center=0, cmap="bwr", xticklabels=10, yticklabels=10);
+        plt.tight_layout();
+        if save_figure:
+            plt.savefig(os.path.join(save_path, 'kernel_weights.png'))
 
     y_binary = [1 if i >= 0 else -1 for i in all_actual_oos]
     pred_binary = [1 if i >= 0 else -1 for i in all_predicted_oos]